@@ -2,12 +2,20 @@
 """
 #!/usr/bin/env python
 import argparse
+import asyncio
+import atexit
+import functools
+import hashlib
 import os
-import sys
+import queue
+import re
 from abc import ABC
-from typing import Dict, List
-from bs4 import BeautifulSoup
-from bs4.element import Tag
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait as futures_wait
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import lxml.html
+from lxml import etree
+from lxml.html import HtmlElement
 from selenium.common.exceptions import StaleElementReferenceException
 from selenium import webdriver
 from selenium.webdriver.common.by import By
@@ -16,33 +24,121 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 
 DEFAULT_HEADLESS_FLAG = '1'
+DEFAULT_POOL_SIZE = 5
+# Only DOM text is scraped, so skip downloading and rendering anything else.
+FIREFOX_PREFERENCES = {
+    'permissions.default.image': 2,
+    'browser.display.use_document_fonts': 0,
+    'media.autoplay.default': 5,
+    'dom.webnotifications.enabled': False,
+    'browser.cache.disk.enable': False,
+    'browser.cache.memory.enable': True,
+}
+WAIT_TIMEOUT = 5
+WAIT_POLL_FREQUENCY = 0.05
+MAX_EXPAND_ROUNDS = 50
+COLLAPSED_ITEMS_SCRIPT = (
+    "return Array.from(arguments[0].getElementsByClassName(arguments[1]))"
+    ".filter(e => e.getAttribute('aria-expanded') !== 'true');"
+)
+INNER_HTML_SCRIPT = "return arguments[0].innerHTML;"
+SEE_LESS_PATTERN = re.compile(r'\s*see less\s*')
+TIME_TOKEN_PATTERN = re.compile(r'\S*time\S*\s*')
+
+
+def _class_predicate(class_name: str) -> str:
+    """Return xpath predicate that matches elements having the given css class."""
+    return 'contains(concat(" ", normalize-space(@class), " "), " {} ")'.format(class_name)
+
+
+def _compile_class_xpath(class_name: str) -> etree.XPath:
+    """Compile xpath that matches descendants having the given css class."""
+    return etree.XPath('.//*[{}]'.format(_class_predicate(class_name)))
+
+
+def _select_one(xpath: etree.XPath, element: HtmlElement) -> Optional[HtmlElement]:
+    """Return first element matched by xpath or None."""
+    matches = xpath(element)
+    return matches[0] if matches else None
+
+
+TEXT_XPATH = etree.XPath('string(.)', smart_strings=False)
+SPAN_XPATH = etree.XPath('.//span')
+H3_XPATH = etree.XPath('.//h3')
+TIME_XPATH = etree.XPath('.//time')
+DESCRIPTION_XPATH = _compile_class_xpath('pv-entity__description')
+LOCATION_XPATH = _compile_class_xpath('pv-entity__location')
+DATE_RANGE_XPATH = _compile_class_xpath('pv-entity__date-range')
+SECONDARY_TITLE_XPATH = _compile_class_xpath('pv-entity__secondary-title')
+COMPANY_SUMMARY_XPATH = _compile_class_xpath('pv-entity__company-summary-info')
+ROLE_DETAILS_PREDICATE = _class_predicate('pv-entity__role-details')
+COMPANY_SUMMARY_PREDICATE = _class_predicate('pv-entity__company-summary-info')
+SECONDARY_TITLE_PREDICATE = _class_predicate('pv-entity__secondary-title')
+# Grouped roles and the list items of ungrouped positions, in document order.
+EXPERIENCE_ENTRIES_XPATH = etree.XPath(
+    './/*[{role}] | .//*[{secondary}][not(ancestor::*[{role}])]/ancestor::li[1]'.format(
+        role=ROLE_DETAILS_PREDICATE,
+        secondary=SECONDARY_TITLE_PREDICATE,
+    )
+)
+IS_ROLE_DETAILS_XPATH = etree.XPath('boolean(self::*[{}])'.format(ROLE_DETAILS_PREDICATE))
+GROUPED_CONTENT_XPATH = etree.XPath(
+    'ancestor::*[.//*[{}]][1]'.format(COMPANY_SUMMARY_PREDICATE)
+)
+SUMMARY_INFO_XPATH = _compile_class_xpath('pv-entity__summary-info')
+DEGREE_NAME_XPATH = _compile_class_xpath('pv-entity__degree-name')
+COMMA_ITEM_XPATH = _compile_class_xpath('pv-entity__comma-item')
+FIELD_OF_STUDY_XPATH = _compile_class_xpath('pv-entity__fos')
+SCHOOL_NAME_XPATH = _compile_class_xpath('pv-entity__school-name')
+DATES_XPATH = _compile_class_xpath('pv-entity__dates')
+CERTIFICATION_SUMMARY_XPATH = _compile_class_xpath('pv-certifications__summary-info')
 
 
 class Forbidden(BaseException):
     pass
 
 
+@functools.lru_cache(maxsize=8)
+def _parse_section_html(html_section: str) -> Tuple[HtmlElement, ...]:
+    """Parse section html once, reusing the result for identical html."""
+    return (lxml.html.fragment_fromstring(html_section, create_parent='div'),)
+
+
 class BaseCrawler(ABC):
+    """Base class that authenticates at LinkedIn.
+
+    Raises Forbidden on construction when authentication fails, so an
+    instance is always authenticated.
+    """
 
     PREFIX_URL = 'https://www.linkedin.com'
+    _LOGIN_URL = '{}/login'.format(PREFIX_URL)
+    _FEED_URL = '{}/feed/'.format(PREFIX_URL)
+    _PROFILE_FMT = '{}/in/{{}}'.format(PREFIX_URL)
 
     def __init__(self, username: str, password: str):
-        sys.setrecursionlimit(100)
         root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
         firefox_options = webdriver.FirefoxOptions()
         firefox_options.headless = bool(int(os.environ.get('HEADLESS', DEFAULT_HEADLESS_FLAG)))
+        for preference, value in FIREFOX_PREFERENCES.items():
+            firefox_options.set_preference(preference, value)
         self.browser = webdriver.Firefox(
             options=firefox_options,
             executable_path=os.path.join(root_path, 'geckodriver'),
         )
-        self.browser.get('{}/login'.format(self.PREFIX_URL))
-        username_element = self.browser.find_element_by_name('session_key')
-        password_element = self.browser.find_element_by_name('session_password')
-        username_element.send_keys(username)
-        password_element.send_keys(password)
-        submit_button = self.browser.find_element_by_xpath('//button[@type="submit"]')
-        submit_button.click()
-        self.authenticated = self.browser.current_url == '{}/feed/'.format(self.PREFIX_URL)
+        try:
+            self.browser.get(self._LOGIN_URL)
+            username_element = self.browser.find_element_by_name('session_key')
+            password_element = self.browser.find_element_by_name('session_password')
+            username_element.send_keys(username)
+            password_element.send_keys(password)
+            submit_button = self.browser.find_element_by_xpath('//button[@type="submit"]')
+            submit_button.click()
+            self.authenticated = self.browser.current_url == self._FEED_URL
+            self._validate_authentication()
+        except BaseException:
+            self.browser.quit()
+            raise
 
     def _validate_authentication(self):
         msg = 'Authentication Error: '
@@ -52,8 +148,7 @@ class BaseCrawler(ABC):
 
     def go_to_profile(self, slug: str):
         """Move to profile page."""
-        self._validate_authentication()
-        self.browser.get('{}/in/{}'.format(self.PREFIX_URL, slug))
+        self.browser.get(self._PROFILE_FMT.format(slug))
 
 
 class Parser:
@@ -61,55 +156,38 @@ class Parser:
     """
 
     @classmethod
-    def parse_experience(cls, row_content: Tag, grouped_content: Tag = None):
+    def parse_experience(cls, row_content: HtmlElement, grouped_content: HtmlElement = None):
         """Method that parses experience section html.
         """
-        if row_content.select('.pv-entity__description'):
-            description_content = row_content.select('.pv-entity__description')[0] \
-                                             .get_text()
-
+        description_content = _select_one(DESCRIPTION_XPATH, row_content)
+        if description_content is not None:
             description = " ".join(
-                description_content.replace('\n', ' ')
-                                   .replace('see less', ' ')
-                                   .replace('  ', ' ')
-                                   .split()
+                SEE_LESS_PATTERN.sub(' ', TEXT_XPATH(description_content)).split()
             )
         else:
             description = ''
 
-        if row_content.select('.pv-entity__location'):
-            location = row_content.select(
-                '.pv-entity__location'
-            )[0].select('span')[-1].get_text()
+        location_content = _select_one(LOCATION_XPATH, row_content)
+        if location_content is not None:
+            location = TEXT_XPATH(SPAN_XPATH(location_content)[-1])
         else:
             location = ''
 
-        if grouped_content:
-            position = row_content.select('h3')[0] \
-                                  .select('span')[-1].get_text() \
-                                  .strip()
-            company = grouped_content.select(
-                '.pv-entity__company-summary-info'
-            )[0].select('span')[1].get_text().strip()
+        if grouped_content is not None:
+            position_content = _select_one(H3_XPATH, row_content)
+            position = TEXT_XPATH(SPAN_XPATH(position_content)[-1]).strip()
+            company_content = _select_one(COMPANY_SUMMARY_XPATH, grouped_content)
+            company = TEXT_XPATH(SPAN_XPATH(company_content)[1]).strip()
         else:
-            position = row_content.select('h3')[0].get_text().strip()
-            contents = row_content.select('.pv-entity__secondary-title')[0] \
-                .get_text() \
-                .split()
-            company = ''.join(
-                [string for string in contents if 'time' not in string]
+            position = TEXT_XPATH(_select_one(H3_XPATH, row_content)).strip()
+            secondary_title = " ".join(
+                TEXT_XPATH(_select_one(SECONDARY_TITLE_XPATH, row_content)).split()
             )
+            company = TIME_TOKEN_PATTERN.sub('', secondary_title).strip()
 
-        start_date = row_content.select('.pv-entity__date-range')[0] \
-                                .select('span')[1] \
-                                .get_text() \
-                                .split('–')[0] \
-                                .strip()
-        end_date = row_content.select('.pv-entity__date-range')[0] \
-                              .select('span')[1] \
-                              .get_text() \
-                              .split('–')[1] \
-                              .strip()
+        date_range_content = _select_one(DATE_RANGE_XPATH, row_content)
+        start_date, _, end_date = TEXT_XPATH(SPAN_XPATH(date_range_content)[1]).partition('–')
+        start_date, end_date = start_date.strip(), end_date.strip()
 
         experience_data = {
             'company': company,
@@ -123,33 +201,36 @@ class Parser:
         return experience_data
 
     @classmethod
-    def parse_education(cls, row_content: Tag) -> Dict:
+    def parse_education(cls, row_content: HtmlElement) -> Dict:
         """Method that parses education section html.
         """
-        current_item = row_content.select('.pv-entity__summary-info')[0]
-        if current_item.select('.pv-entity__degree-name'):
-            degree = current_item.select('.pv-entity__degree-name')[0] \
-                                 .select('.pv-entity__comma-item')[0] \
-                                 .get_text()
+        current_item = _select_one(SUMMARY_INFO_XPATH, row_content)
+        degree_content = _select_one(DEGREE_NAME_XPATH, current_item)
+        if degree_content is not None:
+            degree = TEXT_XPATH(_select_one(COMMA_ITEM_XPATH, degree_content))
         else:
             degree = ''
 
-        if current_item.select('.pv-entity__fos'):
-            field_of_study = current_item.select('.pv-entity__fos')[0] \
-                .select('span')[-1] \
-                .get_text()
+        field_of_study_content = _select_one(FIELD_OF_STUDY_XPATH, current_item)
+        if field_of_study_content is not None:
+            field_of_study = TEXT_XPATH(SPAN_XPATH(field_of_study_content)[-1])
         else:
             field_of_study = ''
 
-        if current_item.select('.pv-entity__school-name'):
-            school = current_item.select('.pv-entity__school-name')[0] \
-                                 .get_text()
+        school_content = _select_one(SCHOOL_NAME_XPATH, current_item)
+        if school_content is not None:
+            school = TEXT_XPATH(school_content)
         else:
             school = ''
 
-        if current_item.select('.pv-entity__dates')[0]:
-            start_date = current_item.select('.pv-entity__dates')[0].select('time')[0].get_text()
-            end_date = current_item.select('.pv-entity__dates')[0].select('time')[1].get_text()
+        dates_content = _select_one(DATES_XPATH, current_item)
+        if dates_content is not None:
+            dates = TIME_XPATH(dates_content)
+            start_date = TEXT_XPATH(dates[0])
+            end_date = TEXT_XPATH(dates[1])
+        else:
+            start_date = ''
+            end_date = ''
 
         return {
             'school': school,
@@ -160,22 +241,24 @@ class Parser:
         }
 
     @classmethod
-    def parse_certification(cls, row_content: Tag) -> Dict:
+    def parse_certification(cls, row_content: HtmlElement) -> Dict:
         """Method that parses certification content html."""
-        current_item = row_content.select('.pv-certifications__summary-info')[0]
-        if current_item.select('span'):
-            company = current_item.select('span')[1].get_text()
-            issue_date = '' if len(current_item) <= 3 else current_item.select('span')[3].get_text()
-            due_date = '' if len(current_item) <= 4 else current_item.select('span')[4].get_text()
-            credential = '' if len(current_item) <= 5 else current_item.select('span')[5].get_text()
+        current_item = _select_one(CERTIFICATION_SUMMARY_XPATH, row_content)
+        spans = SPAN_XPATH(current_item)
+        if spans:
+            company = TEXT_XPATH(spans[1])
+            issue_date = '' if len(spans) <= 3 else TEXT_XPATH(spans[3])
+            due_date = '' if len(spans) <= 4 else TEXT_XPATH(spans[4])
+            credential = '' if len(spans) <= 5 else TEXT_XPATH(spans[5])
         else:
             company = ''
             issue_date = ''
             due_date = ''
             credential = ''
 
-        if current_item.select('h3'):
-            title = current_item.select('h3')[0].get_text()
+        title_content = _select_one(H3_XPATH, current_item)
+        if title_content is not None:
+            title = TEXT_XPATH(title_content)
         else:
             title = ''
 
@@ -188,12 +271,9 @@ class Parser:
         }
 
     @classmethod
-    def parse_about(cls, row_content: Tag) -> str:
+    def parse_about(cls, row_content: HtmlElement) -> str:
         """Method that parses about section html."""
-        return " ".join(row_content.get_text()
-                                   .replace('\n', ' ')
-                                   .replace('  ', ' ')
-                                   .split())
+        return " ".join(TEXT_XPATH(row_content).split())
 
 
 class Crawler(BaseCrawler):
@@ -202,34 +282,41 @@ class Crawler(BaseCrawler):
 
     @classmethod
     def _get_section_elements(cls, selector: str, method: callable):
-        html_section = method()
-        soup = BeautifulSoup(html_section, 'lxml')
-        rows = soup.select('html')
-        return rows
+        return _parse_section_html(method())
 
     def _expand_items(self, section: FirefoxWebElement, element_class: str):
-        elements = section.find_elements_by_class_name(element_class)
-        for element in elements:
+        for _ in range(MAX_EXPAND_ROUNDS):
             try:
-                if element.get_attribute('aria-expanded') != 'true' and EC.element_to_be_clickable(
-                    element
-                ):
-                    element.click()
+                collapsed = self.browser.execute_script(
+                    COLLAPSED_ITEMS_SCRIPT, section, element_class
+                )
             except StaleElementReferenceException:
                 continue
+            if not collapsed:
+                return
 
-        try:
-            self._expand_items(section, element_class)
-        except RecursionError:
-            return
-
-    def _fetch_elements_by_class(self, class_name: str) -> FirefoxWebElement:
-        WebDriverWait(self.browser, 1).until(
-            EC.presence_of_element_located((By.CLASS_NAME, class_name))
+            changed = False
+            for element in collapsed:
+                try:
+                    element.click()
+                    changed = True
+                except StaleElementReferenceException:
+                    continue
+
+            if not changed:
+                return
+
+    def _get_inner_html(self, section: FirefoxWebElement) -> str:
+        return self.browser.execute_script(INNER_HTML_SCRIPT, section)
+
+    def _fetch_elements_by_class(self, class_name: str) -> List[FirefoxWebElement]:
+        return WebDriverWait(
+            self.browser,
+            timeout=WAIT_TIMEOUT,
+            poll_frequency=WAIT_POLL_FREQUENCY,
+        ).until(
+            EC.presence_of_all_elements_located((By.CLASS_NAME, class_name))
         )
-        section = self.browser.find_elements_by_class_name(class_name)
-
-        return section
 
     def _fetch_arbitrary_section_html(
         self,
@@ -244,7 +331,7 @@ class Crawler(BaseCrawler):
         else:
             section = None
         self._expand_items(section=section, element_class=item_expander_class)
-        return section.get_attribute('innerHTML')
+        return self._get_inner_html(section)
 
     def _fetch_about_section_html(self) -> FirefoxWebElement:
         return self._fetch_arbitrary_section_html(
@@ -272,71 +359,68 @@ class Crawler(BaseCrawler):
             element_class='pv-profile-section__see-more-inline'
         )
 
-        return experience_section.get_attribute('innerHTML')
+        return self._get_inner_html(experience_section)
 
     def _fetch_arbitrary_data(
         self,
         section_method: callable,
         parser_method: callable,
         selector: str,
-    ):
+    ) -> Iterator:
         elements = self._get_section_elements(
             method=section_method,
             selector=selector,
-        )[0]
-        if not isinstance(elements, list):
-            return [parser_method(elements)]
+        )
+        return (parser_method(element) for element in elements)
 
-        items = []
-        for item in elements:
-            items.append(parser_method(item))
+    @classmethod
+    def _iter_experience_entries(
+        cls,
+        tree: HtmlElement,
+    ) -> Iterator[Tuple[HtmlElement, Optional[HtmlElement]]]:
+        for entry in EXPERIENCE_ENTRIES_XPATH(tree):
+            if IS_ROLE_DETAILS_XPATH(entry):
+                yield entry, _select_one(GROUPED_CONTENT_XPATH, entry)
+            else:
+                yield entry, None
 
-        return items
+    @classmethod
+    def _parse_experience_rows(cls, tree: HtmlElement) -> Iterator[Dict]:
+        for row_content, grouped_content in cls._iter_experience_entries(tree):
+            yield Parser.parse_experience(row_content, grouped_content)
 
-    def fetch_about_data(self) -> str:
+    def fetch_about_data(self) -> Iterator[str]:
         """Fetch data from about section.
         """
-        self._validate_authentication()
         return self._fetch_arbitrary_data(
             section_method=self._fetch_about_section_html,
             parser_method=Parser.parse_about,
             selector='.pv-about-section'
         )
 
-    def fetch_experience_data(self) -> List[Dict]:
+    def fetch_experience_data(self) -> Iterator[Dict]:
         """Fetch data from experience section.
+
+        Section html is fetched right away, rows are parsed while iterating.
         """
-        self._validate_authentication()
-        experiences = []
-        elements = self._get_section_elements(
+        tree = self._get_section_elements(
             method=self._fetch_experiences_section_html,
             selector='.experience-section',
         )[0]
-        for row in elements:
-            if row.select('.pv-entity__company-summary-info'):
-                for row_detail in row.select('.pv-entity__role-details'):
-                    experiences.append(
-                        Parser.parse_experience(row_detail, row)
-                    )
-            if row.select('.pv-entity__secondary-title'):
-                experiences.append(Parser.parse_experience(row))
-
-        return experiences
-
-    def fetch_education_data(self) -> List[Dict]:
+        return self._parse_experience_rows(tree)
+
+    def fetch_education_data(self) -> Iterator[Dict]:
         """Fetch data from education section.
         """
-        self._validate_authentication()
         return self._fetch_arbitrary_data(
             section_method=self._fetch_education_section_html,
             parser_method=Parser.parse_education,
             selector='.education-section',
         )
 
-    def fetch_certification_data(self) -> List[Dict]:
+    def fetch_certification_data(self) -> Iterator[Dict]:
         """Fetch data from certification section.
         """
-        self._validate_authentication()
         return self._fetch_arbitrary_data(
             section_method=self._fetch_certification_section_html,
             parser_method=Parser.parse_certification,
@@ -346,7 +430,6 @@ class Crawler(BaseCrawler):
     def fetch_skills_data(self) -> List[str]:
         """Fetch data from skills elements.
         """
-        self._validate_authentication()
         skills_tag_class = "pv-skill-category-entity__name-text"
         elements = self._fetch_elements_by_class(
             class_name=skills_tag_class
@@ -357,25 +440,108 @@ class Crawler(BaseCrawler):
 
         return skills
 
+    def fetch_profile_data(self, slug: str) -> Dict:
+        """Move to profile page and fetch its data.
+        """
+        self.go_to_profile(slug=slug)
+        return {
+            # 'about': list(self.fetch_about_data()),
+            # 'education': list(self.fetch_education_data()),
+            # 'certifications': list(self.fetch_certification_data()),
+            # 'skills': self.fetch_skills_data(),
+            'experiences': list(self.fetch_experience_data()),
+        }
+
+
+class CrawlerPool:
+    """Class that keeps authenticated crawlers to fetch many profiles at once.
+    """
+
+    def __init__(self, username: str, password: str, size: int = DEFAULT_POOL_SIZE):
+        self.size = size
+        self._pool = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=size)
+        futures = [
+            self._executor.submit(Crawler, username=username, password=password)
+            for _ in range(size)
+        ]
+        futures_wait(futures)
+        errors = [future.exception() for future in futures if future.exception()]
+        if errors:
+            for future in futures:
+                if not future.exception():
+                    future.result().browser.quit()
+            self._executor.shutdown()
+            raise errors[0]
+
+        for future in futures:
+            self._pool.put(future.result())
+        atexit.register(self.close)
+
+    def __enter__(self) -> 'CrawlerPool':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _scrape_one(self, slug: str) -> Dict:
+        crawler = self._pool.get()
+        try:
+            return crawler.fetch_profile_data(slug=slug)
+        finally:
+            self._pool.put(crawler)
+
+    def scrape_many(self, slugs: Iterable[str]) -> List[Dict]:
+        """Fetch data from profiles, keeping the slugs order.
+        """
+        return list(self._executor.map(self._scrape_one, slugs))
+
+    async def scrape_many_async(self, slugs: Iterable[str]) -> List[Dict]:
+        """Fetch data from profiles without blocking the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*[
+            loop.run_in_executor(self._executor, self._scrape_one, slug) for slug in slugs
+        ])
+
+    def close(self):
+        """Wait for running scrapes, then quit every browser kept by the pool."""
+        atexit.unregister(self.close)
+        self._executor.shutdown()
+        while not self._pool.empty():
+            self._pool.get().browser.quit()
+
+
+_INSTANCE_CACHE: Dict[str, Crawler] = {}
+
+
+def _quit_cached_crawlers():
+    for crawler in _INSTANCE_CACHE.values():
+        crawler.browser.quit()
+    _INSTANCE_CACHE.clear()
+
+
+atexit.register(_quit_cached_crawlers)
+
+
+def get_crawler(username: str, password: str) -> Crawler:
+    """Return an authenticated crawler, reusing the one already open for username."""
+    key = hashlib.sha1(username.encode()).hexdigest()
+    if key not in _INSTANCE_CACHE:
+        _INSTANCE_CACHE[key] = Crawler(username=username, password=password)
+    return _INSTANCE_CACHE[key]
+
 
 def run():
     """Run Crawler."""
-    crawler = Crawler(
+    crawler = get_crawler(
         username=os.environ.get('EMAIL'),
         password=os.environ.get('PASSWORD'),
     )
     parser = argparse.ArgumentParser()
     parser.add_argument('--profile', help='Profile slug on url suffix. e.g maccabelli')
     args = parser.parse_args()
-    crawler.go_to_profile(slug=args.profile)
-    data = {
-        # 'about': crawler.fetch_about_data(),
-        # 'education': crawler.fetch_education_data(),
-        # 'certifications': crawler.fetch_certification_data(),
-        # 'skills': crawler.fetch_skills_data(),
-        'experiences': crawler.fetch_experience_data(),
-    }
-    return data
+    return crawler.fetch_profile_data(slug=args.profile)
 
 
 def main():